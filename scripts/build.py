@@ -6,14 +6,15 @@
 
 Usage:
     build.py [--help]
-    build.py full
+    build.py [--profile=<name>] full
     build.py clean
     build.py sync
     build.py map
-    build.py build
+    build.py [--profile=<name>] build
 
 Options:
     --help              Shows this screen.
+    --profile=<name>    Build profile from `config.yaml` to use [default: debug].
 
 Subcommands:
     full                Runs all the commands below in sequence.
@@ -67,6 +68,33 @@ def __init__(self):
         self.build_dir = self.project_root / 'build'
         self.install_dir = self.sysroot_dir / 'build'
 
+        # Set up by `load_profile`
+        self.profile = None
+        self.profile_dir = None
+        self.flags = []
+        self.link_flags = []
+
+    def load_profile(self, name: str):
+        # Profiles live under `build_<name>` in the config.
+        # Every profile gets its own object tree in `build/<name>/`,
+        # so switching between them never throws away the other's objects
+        profile = self.config.get(f'build_{name}')
+        if profile is None:
+            Logger.perror(f'Build profile [{name}] not found in config!')
+            Logger.exit(errno.EINVAL)
+
+        self.profile = name
+        self.profile_dir = self.build_dir / name
+        self.flags = list(profile.get('flags') or [])
+        self.link_flags = list(profile.get('link_flags') or [])
+
+        # LTO has to be passed to the compiler and the linker alike,
+        # the compiler flags are passed on to the link step anyway
+        if profile.get('lto') is True:
+            self.flags.append('-flto')
+
+        Logger.pdebug(f'Using the [{name}] profile: {" ".join(self.flags)}')
+
     def cleanup(self):
         Logger.pinfo('Initializing clean-up...', start='\n')
 
@@ -100,28 +128,88 @@ def src_map_files(self):
 
         self.include_dirs = [self.libs_dir, self.src_dir]
 
+    def get_object_path(self, path: Path) -> Path:
+        # Mirrors the source tree inside the profile directory.
+        # The source suffix is kept, so `Foo.cc` and `Foo.s` don't share an object
+        obj = self.profile_dir / path.relative_to(self.project_root).with_name(f'{path.name}.o')
+        if not obj.parent.exists():
+            obj.parent.mkdir(parents=True)
+
+        return obj
+
+    def needs_rebuild(self, obj: Path, deps: List[Path]) -> bool:
+        # An object is stale if it's missing or older than any of its dependencies
+        if not obj.exists():
+            return True
+
+        obj_time = obj.stat().st_mtime
+        return any(dep.stat().st_mtime > obj_time for dep in deps)
+
+    def run_step(self, cmd: list, path: Path):
+        Logger.pdebug(f'Building [{path.name}]')
+        result = sp.run(cmd)
+        if result.returncode != 0:
+            Logger.perror(f'Could not build [{path.name}]')
+            Logger.exit(errno.EIO)
+
+    def get_image_size(self, image: Path) -> int:
+        # The loaded size of the image (text, data and bss) as reported by `size`.
+        # The file size isn't useful here, it includes the symbol tables
+        # and the page padding from the linker script
+        size_cmd = [self.toolchain_dir / f'{self.target}-size', image]
+        result = sp.run(size_cmd, stdout=sp.PIPE, universal_newlines=True)
+        if result.returncode != 0:
+            Logger.perror(f'Could not get the size of [{image.name}]')
+            Logger.exit(errno.EIO)
+
+        # Berkeley format: `text data bss dec hex filename`
+        return int(result.stdout.splitlines()[1].split()[3])
+
+    def report_image_size(self, image: Path, previous_size: int):
+        # Compares the image against its last link and the images of the other profiles
+        size = self.get_image_size(image)
+        Logger.pinfo(f'[{image.name}] ({self.profile}) loads {size} bytes')
+
+        if previous_size is not None:
+            Logger.pinfo(f'Difference from the previous link: {size - previous_size:+} bytes')
+
+        for other in sorted(self.build_dir.glob(f'*/{image.name}')):
+            if other != image:
+                other_size = self.get_image_size(other)
+                Logger.pinfo(f'Difference from the [{other.parent.name}] profile: {size - other_size:+} bytes')
+
     def make_build_dirs(self):
-        Logger.pinfo('Building the source code...', start='\n')
+        Logger.pinfo(f'Building the source code with the [{self.profile}] profile...', start='\n')
 
         compiler = self.toolchain_dir / f'{self.target}-g++'
         assembler = self.toolchain_dir / f'{self.target}-as'
-        linker = self.toolchain_dir / f'{self.target}-ld'
 
-        sources = dict(zip(self.sources, self.assemblies))
-        for source, assembly in sources.items():
-            assembly_obj = self.build_dir / assembly.name.replace('.s', '.o')
-            source_obj = self.build_dir / source.name.replace('.cc', '.o')
+        # The config holds the flags, so editing it invalidates every object
+        headers = self.headers or []
+        objects = []
+
+        for assembly in self.assemblies or []:
+            assembly_obj = self.get_object_path(assembly)
+            if self.needs_rebuild(assembly_obj, [assembly, self.config_file]):
+                assembly_cmd = [assembler, assembly, '-o', assembly_obj]
+                self.run_step(assembly_cmd, assembly)
+            objects.append(assembly_obj)
 
-            assembly_cmd = [assembler, assembly, '-o', assembly_obj]
-            sp.run(assembly_cmd)
+        for source in self.sources or []:
+            source_obj = self.get_object_path(source)
+            if self.needs_rebuild(source_obj, [source, self.config_file, *headers]):
+                source_cmd = [compiler, '-c', source, '-o', source_obj, f'-I{self.libc_dir.resolve()}', *self.flags]
+                self.run_step(source_cmd, source)
+            objects.append(source_obj)
 
-            additional_src_args = ['-ffreestanding', '-O2', '-Wall', '-Wextra', '-fno-exceptions', '-fno-rtti', '--std=c++17', '-nostdlib', '-lgcc', '-nostartfiles']
-            source_cmd = [compiler, source, '-o', source_obj, f'-I{self.libc_dir.resolve()}', *additional_src_args]
-            sp.run(source_cmd)
+        image = self.profile_dir / f'{self.program_name.lower()}.bin'
+        previous_size = self.get_image_size(image) if image.exists() else None
 
-            additional_args = ['-O2', '-nostdlib', '-lgcc', '-ffreestanding', '-fno-rtti', '-fno-exceptions', '-std=c++17']
-            image_cmd = [compiler, '-T', self.src_dir / 'MainLinker.ld', '-o', self.build_dir / 'thermios.bin', source_obj, assembly_obj, *additional_args]
-            sp.run(image_cmd)
+        image_args = [*self.flags, *self.link_flags, '-nostdlib', '-lgcc']
+        image_cmd = [compiler, '-T', self.src_dir / 'MainLinker.ld', '-o', image, *objects, *image_args]
+        self.run_step(image_cmd, image)
+
+        self.report_image_size(image, previous_size)
 
 
 def main():
@@ -129,6 +217,7 @@ def main():
     args = docopt(__doc__, version=builder.get_version_number(), options_first=True)
 
     if args['full'] is True:
+        builder.load_profile(args['--profile'])
         builder.src_map_files()
         builder.make_build_dirs()
 
@@ -139,7 +228,9 @@ def main():
     elif args['map'] is True:
         print('Map')
     elif args['build'] is True:
-        print('Build')
+        builder.load_profile(args['--profile'])
+        builder.src_map_files()
+        builder.make_build_dirs()
     else:
         Logger.perror('Unhandled option!')
         Logger.exit(errno.EINVAL)